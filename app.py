@@ -1,10 +1,20 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
+import time
+import json
+
+@st.cache_resource
+def get_session():
+    """Keep-alive session shared across reruns, so calls reuse pooled connections"""
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+    return session
 
 def generate_sql(query, tables):
     try:
-        response = requests.get(
+        response = get_session().get(
             "http://0.0.0.0:8000/generate_sql",
             json={"query": query, "tables": tables},
             headers={"Content-Type": "application/json"},
@@ -12,7 +22,7 @@ def generate_sql(query, tables):
             timeout=300
         )
         response.raise_for_status()
-        return response.iter_content(chunk_size=None, decode_unicode=True)
+        return response.iter_content(chunk_size=64, decode_unicode=True)
     except requests.exceptions.RequestException as e:
         if hasattr(e, 'response') and e.response is not None:
             error_details = e.response.json()
@@ -21,20 +31,34 @@ def generate_sql(query, tables):
     
 def execute_sql(sql_query):
     try:
-        response = requests.get(
+        response = get_session().get(
             "http://0.0.0.0:8000/execute_sql",
             json={"sql_query": sql_query},
             headers={"Content-Type": "application/json"},
+            stream=True,
             timeout=60
         )
         response.raise_for_status()
-        return response.json()
+
+        # NDJSON: columns line, then chunks of rows (or a single error line)
+        result = {"columns": [], "data": []}
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                return chunk
+            if "columns" in chunk:
+                result["columns"] = chunk["columns"]
+            else:
+                result["data"].extend(chunk["data"])
+        return result
     except requests.exceptions.RequestException as e:
         return {"error": str(e)}
 
 def get_database_schema():
     try:
-        response = requests.get(
+        response = get_session().get(
             "http://0.0.0.0:8000/get_database_schema",
             json={},
             headers={"Content-Type": "application/json"},
@@ -48,6 +72,24 @@ def get_database_schema():
             return {"error": f"Backend Error: {error_details.get('detail', str(e))}"}
         return {"error": f"Connection Error: {str(e)}"}
     
+@st.cache_data(ttl=600)
+def get_cached_database_schema():
+    return get_database_schema()
+
+@st.cache_data
+def format_schema_tables(schema):
+    """Split the schema into (table name, markdown) pairs for the sidebar"""
+    tables = []
+    for t in schema.split("\n\n"):
+        table_name = t[t.find(" ") + 1:t.find("\n")]
+        t = t.replace("\n", "  \n")
+        t = t.replace("Table", "**Table**")
+        t = t.replace("Columns", "**Columns**")
+        t = t.replace("Primary Key", "**Primary Key**")
+        t = t.replace("Foreign Key", "**Foreign Key**")
+        tables.append((table_name, t))
+    return tables
+    
 def main():
     st.set_page_config(page_title="Text-2-SQL", layout="wide", menu_items={})
     st.title("Text-2-SQL")
@@ -76,16 +118,16 @@ def main():
     with st.sidebar:
         st.header("Database Schema", divider="gray")
         st.subheader("Check all tables relevant to your query.")
-        response = get_database_schema()
-        for t in response["schema"].split("\n\n"):
-            table_name = t[t.find(" ") + 1:t.find("\n")]
-            t = t.replace("\n", "  \n")
-            t = t.replace("Table", "**Table**")
-            t = t.replace("Columns", "**Columns**")
-            t = t.replace("Primary Key", "**Primary Key**")
-            t = t.replace("Foreign Key", "**Foreign Key**")
-            check = st.checkbox(t)
-            filter_table_checkboxes.append((check, table_name))
+        response = get_cached_database_schema()
+        if response.get("error"):
+            # do not keep a failed response for the next reruns
+            get_cached_database_schema.clear()
+            st.error(response["error"])
+        else:
+            for table_name, t in format_schema_tables(response["schema"]):
+                # keyed checkboxes keep their state in st.session_state across reruns
+                check = st.checkbox(t, key=f"table_{table_name}")
+                filter_table_checkboxes.append((check, table_name))
 
     try:
         question = st.text_area("Enter your question in natural language:", height=100)
@@ -110,9 +152,16 @@ def main():
                 else:
                     sql_output = st.empty()
                     full_response = ""
+                    last_render = time.monotonic()
+                    last_rendered_len = 0
                     for token in response_stream:
                         full_response += token
-                        sql_output.info(f"{full_response}")
+                        # re-render at most every 80ms or 32 new characters
+                        if time.monotonic() - last_render > 0.08 or len(full_response) - last_rendered_len > 32:
+                            sql_output.info(f"{full_response}")
+                            last_render = time.monotonic()
+                            last_rendered_len = len(full_response)
+                    sql_output.info(f"{full_response}")
 
                     if "```sql" in full_response:
                         sql_query = full_response.split("```sql")[-1].split("```")[0].strip()
@@ -0,0 +1,85 @@
+import os
+import json
+import random
+import torch
+from dotenv import load_dotenv
+from tensorrt_llm import LLM, BuildConfig
+from tensorrt_llm.llmapi import QuantConfig, CalibConfig
+from tensorrt_llm.quantization import QuantAlgo
+
+load_dotenv()
+
+model_name = "Qwen/Qwen2.5-Coder-7B-Instruct"
+engine_dir = os.getenv("TRTLLM_ENGINE_DIR", "qwen2.5-coder-7b-engine")
+
+# Text-to-SQL pairs used to calibrate the FP8 scales
+actuals_filename = os.getenv("CALIB_ACTUALS_FILE", "evaluate/mini_dev_postgresql.json")
+calib_dir = os.getenv("CALIB_DATASET_DIR", "calib_dataset")
+calib_num_samples = 512
+
+max_input_len = 4096
+max_output_len = 1024
+
+def supports_fp8():
+    """FP8 Tensor Cores are available from Ada (sm_89) and Hopper (sm_90) onwards"""
+    return torch.cuda.get_device_capability() >= (8, 9)
+
+def get_quant_config():
+    """FP8 weights and KV cache, falling back to AWQ Int4 on pre-Ada GPUs"""
+    if supports_fp8():
+        return QuantConfig(quant_algo=QuantAlgo.FP8, kv_cache_quant_algo=QuantAlgo.FP8)
+    return QuantConfig(quant_algo=QuantAlgo.W4A16_AWQ)
+
+def create_calib_dataset():
+    """Write SQL prompts sampled from the actuals file as a local text dataset"""
+    with open(actuals_filename, "r") as af:
+        actuals = json.load(af)
+
+    samples = random.Random(0).sample(actuals, min(calib_num_samples, len(actuals)))
+
+    os.makedirs(calib_dir, exist_ok=True)
+    with open(os.path.join(calib_dir, "calib.jsonl"), "w") as cf:
+        for sample in samples:
+            text = f"Question:\n{sample['question']}\n\nSQL:\n{sample['SQL']}"
+            cf.write(json.dumps({"text": text}) + "\n")
+
+    return CalibConfig(calib_dataset=calib_dir, calib_batches=len(samples))
+
+def get_build_config(quant_config):
+    """Engine build options, equivalent to the trtllm-build flags:
+    --gemm_plugin float16 --gpt_attention_plugin float16 --paged_kv_cache enable
+    --max_batch_size 16 --max_input_len 4096 --max_output_len 1024
+    plus --use_paged_context_fmha enable for KV cache block reuse
+    and --use_fp8_context_fmha enable when building for FP8
+    """
+    build_config = BuildConfig(
+        max_batch_size=16,
+        max_input_len=max_input_len,
+        max_seq_len=max_input_len + max_output_len
+    )
+    build_config.plugin_config.gpt_attention_plugin = "float16"
+    build_config.plugin_config.paged_kv_cache = True
+    # Required for KV cache block reuse at runtime
+    build_config.plugin_config.use_paged_context_fmha = True
+
+    if quant_config.quant_algo == QuantAlgo.FP8:
+        build_config.plugin_config.gemm_plugin = "fp8"
+        build_config.plugin_config.use_fp8_context_fmha = True
+    else:
+        build_config.plugin_config.gemm_plugin = "float16"
+    return build_config
+
+def build_engine():
+    """Quantize the model and compile it into a serialized engine"""
+    quant_config = get_quant_config()
+    llm = LLM(
+        model=model_name,
+        quant_config=quant_config,
+        calib_config=create_calib_dataset(),
+        build_config=get_build_config(quant_config)
+    )
+    llm.save(engine_dir)
+    print(f"{quant_config.quant_algo} engine saved to {engine_dir}")
+
+if __name__ == "__main__":
+    build_engine()
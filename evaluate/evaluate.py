@@ -1,7 +1,12 @@
-from sql import execute_sql_query
-import json
+from sql import execute_sql_query, hash_sql_query
+import ijson
 from tqdm import tqdm
 from decimal import Decimal
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter, defaultdict
+from functools import lru_cache
+import re
 
 def normalize_value(v):
     if isinstance(v, str):
@@ -20,12 +25,39 @@ def normalize_value(v):
     
     return v
 
+BOOL_MAP = {"true": 1.0, "yes": 1.0, "1": 1.0, "false": 0.0, "no": 0.0, "0": 0.0}
+NUMERIC_TYPES = {"boolean", "integer", "floating", "decimal", "mixed-integer-float"}
+
+def normalize_column(column):
+    # same rules as normalize_value, applied to a whole column at once
+    inferred_type = pd.api.types.infer_dtype(column, skipna=True)
+    if inferred_type == "string":
+        text = column.str.strip().str.lower()
+        column = text.map(lambda v: BOOL_MAP.get(v, v))
+    elif inferred_type in NUMERIC_TYPES:
+        # python's round, numpy rounds half-way values differently
+        column = column.astype(float).map(lambda v: round(v, 5))
+    elif inferred_type != "empty": # mixed types, dates, ...
+        column = column.map(normalize_value)
+
+    # keep NULLs as None so they compare equal across result sets
+    return column.astype(object).where(column.notna(), None)
+
 def normalize(row):
     return tuple(normalize_value(v) for v in row)
 
+# building a DataFrame only pays off for large result sets
+DATAFRAME_MIN_ROWS = 1000
+
 def normalize_results(results):
+    if len(results) < DATAFRAME_MIN_ROWS:
+        # ignore duplicate rows
+        return frozenset(normalize(row) for row in results)
+
+    df = pd.DataFrame(list(results))
+    df = pd.DataFrame({i: normalize_column(df[i]) for i in df.columns})
     # ignore duplicate rows
-    return set(normalize(row) for row in results)
+    return frozenset(df.itertuples(index=False, name=None))
 
 def is_similar(exec_a, exec_p):
     res_a = normalize_results(exec_a["data"])
@@ -34,32 +66,130 @@ def is_similar(exec_a, exec_p):
     if res_a == res_p:
         return True
     
+    rows_a = [frozenset(row_a) for row_a in res_a]
+    rows_a_union = frozenset().union(*rows_a)
+    has_empty_row_a = any(not row_a for row_a in rows_a)
+
+    # value -> indices of the gold rows containing it
+    index = defaultdict(list)
+    for i, row_a in enumerate(rows_a):
+        for v in row_a:
+            index[v].append(i)
+
     count = 0
     for row_p in res_p:
+        row_p = frozenset(row_p)
         # ignore extra columns as long as data is the same
-        if any(set(row_a).issubset(set(row_p)) for row_a in res_a) or \
-           any(set(row_p).issubset(set(row_a)) for row_a in res_a): 
-            count += 1
+        if has_empty_row_a or (not row_p and rows_a):
+            matched = True
+        elif row_p.isdisjoint(rows_a_union):
+            matched = False
         else:
+            # number of values each candidate gold row shares with row_p
+            hits = Counter()
+            for v in row_p:
+                hits.update(index.get(v, ()))
+            matched = any(n == len(rows_a[i]) or n == len(row_p) for i, n in hits.items())
+
+        if not matched:
+            return False
+        count += 1
+        if count > len(res_a):
             return False
     return count == len(res_a)
 
+# literals and quoted identifiers are kept verbatim by normalize_sql
+_QUOTED_RE = re.compile(
+    r"[eE]'(?:[^'\\]|\\[\s\S]|'')*'|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$(\w*)\$[\s\S]*?\$\1\$"
+)
+
+def normalize_whitespace_and_case(text):
+    # a newline still ends a line comment, so it is kept
+    text = re.sub(r"\s*\n\s*", "\n", text.lower())
+    return re.sub(r"[ \t\r\f\v]+", " ", text)
+
+def normalize_sql(sql_query):
+    """
+    Cache key for a query: case and whitespace are collapsed outside of
+    literals and quoted identifiers, which cannot change its meaning
+    """
+    parts = []
+    pos = 0
+    for match in _QUOTED_RE.finditer(sql_query):
+        parts.append(normalize_whitespace_and_case(sql_query[pos:match.start()]))
+        parts.append(match.group(0))
+        pos = match.end()
+    parts.append(normalize_whitespace_and_case(sql_query[pos:]))
+    return "".join(parts).strip()
+
+# normalized SQL -> first original SQL seen for it
+# the normalized text is only a cache key, the original is what gets executed
+original_sql = {}
+
+def sql_key(sql_query):
+    key = normalize_sql(sql_query)
+    original_sql.setdefault(key, sql_query)
+    return key
+
+@lru_cache(maxsize=4096)
+def cached_execute_sql_query(key):
+    # gold and predicted queries repeat across pairs, execute each one only once
+    result = execute_sql_query(original_sql[key])
+    if "data" in result:
+        return {
+            "columns": tuple(result["columns"]),
+            "data": tuple(tuple(row) for row in result["data"])
+        }
+    return result
+
+@lru_cache(maxsize=4096)
+def cached_hash_sql_query(key):
+    return hash_sql_query(original_sql[key])
+
+# pairs are compared concurrently, each pair runs its two queries concurrently
+pair_executor = ThreadPoolExecutor(max_workers=16)
+query_executor = ThreadPoolExecutor(max_workers=32)
+
+def run_pair(key_p, key_a):
+    # fast path: identical result hashes and column types from the database
+    future_a = query_executor.submit(cached_hash_sql_query, key_a)
+    future_p = query_executor.submit(cached_hash_sql_query, key_p)
+    hash_a = future_a.result()
+    hash_p = future_p.result()
+    if "hash" in hash_a and "hash" in hash_p and \
+       hash_a["hash"] == hash_p["hash"] and hash_a["types"] == hash_p["types"]:
+        return True
+
+    # otherwise compare the normalized rows
+    future_a = query_executor.submit(cached_execute_sql_query, key_a)
+    future_p = query_executor.submit(cached_execute_sql_query, key_p)
+    exec_a = future_a.result()
+    exec_p = future_p.result()
+
+    return "data" in exec_p and "data" in exec_a and is_similar(exec_a, exec_p)
+
 predicts_filename = "output.json"
 actuals_filename = "mini_dev_postgresql.json"
 
 correct = 0
 total = 0
-with open(predicts_filename, "r") as pf, open(actuals_filename, "r") as af:
-    predicts = json.load(pf)
-    actuals = json.load(af)
-    for p, a in (pbar := tqdm(list(zip(predicts, actuals)))):
-        exec_a = execute_sql_query(a["SQL"])
-        exec_p = execute_sql_query(p["SQL"])
-
-        if "data" in exec_p and "data" in exec_a and is_similar(exec_a, exec_p):
-            correct += 1
+with open(predicts_filename, "rb") as pf, open(actuals_filename, "rb") as af:
+    # records are parsed lazily and submitted as soon as they are read
+    futures = {}
+    pair_counts = Counter()
+    for p, a in zip(ijson.items(pf, "item"), ijson.items(af, "item")):
+        pair = (sql_key(p["SQL"]), sql_key(a["SQL"]))
+        # identical (predicted, gold) pairs are only compared once
+        if pair not in pair_counts:
+            futures[pair_executor.submit(run_pair, *pair)] = pair
+        pair_counts[pair] += 1
+
+    for future in (pbar := tqdm(as_completed(futures), total=len(futures))):
+        count = pair_counts[futures[future]]
+        if future.result():
+            correct += count
         
-        total += 1
+        total += count
         pbar.set_postfix_str(f"ACCURACY: {correct}/{total} = {round(correct/total, 3)}")
     
     print(f"FINAL ACCURACY: {correct}/{total} = {round(correct/total, 3)}")
\ No newline at end of file
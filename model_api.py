@@ -1,30 +1,109 @@
-from fastapi import FastAPI, HTTPException
+import os
+import asyncio
+import json
+from itertools import chain
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, StoppingCriteria
-from threading import Thread, Event
-from sql import get_database_schema, get_normalized_create_statement, execute_sql_query
-
-model_name = "Qwen/Qwen2.5-Coder-7B-Instruct-GPTQ-Int4"
-model = AutoModelForCausalLM.from_pretrained(
-    model_name,
-    torch_dtype="auto",
-    device_map="auto"
+from transformers import AutoTokenizer
+from tensorrt_llm import LLM, SamplingParams
+from tensorrt_llm.llmapi import KvCacheConfig, ExtendedRuntimePerfKnobConfig
+from sql import get_database_schema, get_normalized_create_statement, stream_sql_query
+from build_engine import model_name, engine_dir, max_output_len
+
+# Engine compiled ahead of time by build_engine.py.
+# The paged KV cache pool is allocated once at startup and reused by every
+# request, block reuse shares the KV cache of the common prompt prefix, and
+# decode steps are replayed from captured CUDA graphs.
+model = LLM(
+    model=engine_dir,
+    tokenizer=model_name,
+    kv_cache_config=KvCacheConfig(
+        enable_block_reuse=True,
+        free_gpu_memory_fraction=float(os.getenv("KV_CACHE_GPU_MEMORY_FRACTION", "0.9"))
+    ),
+    extended_runtime_perf_knob_config=ExtendedRuntimePerfKnobConfig(
+        cuda_graph_mode=True,
+        cuda_graph_cache_size=16
+    )
 )
 tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-model.eval()
+sampling_params = SamplingParams(max_tokens=max_output_len)
+
+# Tokenization and psycopg2 calls block, run them off the event loop
+blocking_executor = ThreadPoolExecutor(max_workers=16)
+
+async def run_blocking(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, func, *args)
+
+# (prompt, output_queue, cancel_event) items waiting to be fed into the engine
+generation_queue = asyncio.Queue()
+generation_tasks = set()
+
+async def abort_on_cancel(generation, cancel_event):
+    """Abort the engine request once its consumer is gone"""
+    await cancel_event.wait()
+    if not generation.finished:
+        generation.abort()
+
+async def run_generation(prompt, output_queue, cancel_event):
+    """Stream text for one prompt into its output queue, ending with None"""
+    watcher = None
+    try:
+        generation = model.generate_async(prompt, sampling_params, streaming=True)
+        watcher = asyncio.create_task(abort_on_cancel(generation, cancel_event))
+        async for output in generation:
+            await output_queue.put(output.outputs[0].text_diff)
+    except Exception as e:
+        print(f"Generation error: {str(e)}\n")
+    finally:
+        if watcher:
+            watcher.cancel()
+        await output_queue.put(None)
+
+async def generation_worker():
+    """
+    Long-lived worker owning the engine.
+    Every queued prompt is submitted right away, so it joins the running
+    batch at the next decode step (in-flight batching) instead of waiting
+    for or aborting the other requests.
+    """
+    while True:
+        prompt, output_queue, cancel_event = await generation_queue.get()
+        task = asyncio.create_task(run_generation(prompt, output_queue, cancel_event))
+        generation_tasks.add(task)
+        task.add_done_callback(generation_tasks.discard)
+
+@asynccontextmanager
+async def lifespan(app):
+    worker = asyncio.create_task(generation_worker())
+    yield
+    worker.cancel()
 
 app = FastAPI(
     title="Text-2-SQL API",
     description="API for converting natural language text to SQL and executing queries",
-    version="1.0"
+    version="1.0",
+    lifespan=lifespan
 )
 
 class QueryRequest(BaseModel):
     query: str
     tables: list[str]
 
+# upper bound on the generations one batch request can queue
+MAX_BATCH_QUESTIONS = 64
+
+class BatchQueryRequest(BaseModel):
+    questions: list[str]
+    tables_per_question: list[list[str]]
+
 class ExecuteRequest(BaseModel):
     sql_query: str
 
@@ -32,16 +111,13 @@ class SchemaRequest(BaseModel):
     None
 
 
-def create_prompt(question, filtered_tables):
-    schema = get_normalized_create_statement(filtered_tables)
-    return f"""You are a data science expert. Below, you are provided with a database schema and a natural language question. Your task is to understand the schema and generate a valid PostgreSQL query to answer the question.
+# Static text and schema first, question last, so the prompt prefix
+# stays identical across questions and its KV cache blocks get reused.
+PROMPT_TEMPLATE = """You are a data science expert. Below, you are provided with a database schema and a natural language question. Your task is to understand the schema and generate a valid PostgreSQL query to answer the question.
     
 Database Schema:
 {schema}
 
-Question:
-{question}
-
 Instructions:
 - Make sure you only output the information that is asked in the question. If the question asks for a specific column, make sure to only include that column in the SELECT clause, nothing more.
 - The generated query should return all of the information asked in the question without any missing or extra information.
@@ -50,81 +126,194 @@ Instructions:
 - If you think some table information is missing or the database schema provided has no relevance with the question, do not answer with any SQL query.
 
 Take a deep breath and think step by step to find the correct SQL query.
+
+Question:
+{question}
 """
 
+def create_prompt(question, filtered_tables):
+    schema = get_normalized_create_statement(filtered_tables)
+    return PROMPT_TEMPLATE.format(schema=schema, question=question)
+
+def apply_chat_template(prompt):
+    messages = [
+        {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
+        {"role": "user", "content": prompt}
+    ]
+    return tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+
+def tokenize(text):
+    return tokenizer.encode(text, add_special_tokens=False)
+
+def tokenize_template():
+    """
+    Pre-tokenize the fixed parts of the chat prompt around the schema and
+    the question, so only those two need tokenizing per request.
+    The whitespace after each of them belongs to the dynamic piece, since
+    the pre-tokenizer merges it with trailing punctuation (");\n\n", "?\n").
+    The fixed parts then start right after a newline or at <|im_end|>,
+    where the pre-tokenizer always splits.
+    """
+    text = apply_chat_template(PROMPT_TEMPLATE.format(schema="{schema}", question="{question}"))
+    prefix, rest = text.split("{schema}\n\n")
+    middle, suffix = rest.split("{question}\n")
+    return tokenize(prefix), tokenize(middle), tokenize(suffix)
+
+prefix_ids, middle_ids, suffix_ids = tokenize_template()
+
+@lru_cache(maxsize=128)
+def tokenize_schema(tables_key):
+    return tuple(tokenize(get_normalized_create_statement(tables_key) + "\n\n"))
+
+def create_prompt_ids(question, filtered_tables):
+    """Token ids of the chat prompt, assembled from the pre-tokenized parts"""
+    schema_ids = tokenize_schema(frozenset(filtered_tables))
+    return prefix_ids + list(schema_ids) + middle_ids + tokenize(question + "\n") + suffix_ids
+
+def prompt_ids_match():
+    """Check that joining the pre-tokenized parts gives the same ids as tokenizing the full prompt"""
+    schema = "create table users (\nid integer,\nname text,\nprimary key (id)\n);"
+    questions = ["How many users are there?", "List the names of all users.", "count users", "(1) users named \"Bob\"!"]
+    for question in questions:
+        full_ids = tokenize(apply_chat_template(PROMPT_TEMPLATE.format(schema=schema, question=question)))
+        joined_ids = prefix_ids + tokenize(schema + "\n\n") + middle_ids + tokenize(question + "\n") + suffix_ids
+        if full_ids != joined_ids:
+            return False
+    return True
+
+use_prompt_ids = prompt_ids_match()
+if not use_prompt_ids:
+    print("Pre-tokenized prompt does not match the chat template, tokenizing full prompts\n")
+
+
+def build_prompt(question, tables):
+    """Chat prompt for the engine, as token ids when the pre-tokenized parts can be used"""
+    # surrounding whitespace would merge with the template's newlines,
+    # such questions are tokenized as part of the full prompt
+    if use_prompt_ids and tables and question == question.strip():
+        return create_prompt_ids(question, tables)
+    return apply_chat_template(create_prompt(question, tables))
+
+async def submit_generation(question, tables):
+    """
+    Queue a generation for one question
+    Returns the output queue (text chunks ending with None) and the event
+    that aborts the generation when set
+    """
+    prompt = await run_blocking(build_prompt, question, tables)
+    output_queue = asyncio.Queue()
+    cancel_event = asyncio.Event()
+    await generation_queue.put((prompt, output_queue, cancel_event))
+    return output_queue, cancel_event
+
+async def generate_text(question, tables):
+    """Full generated text for one question"""
+    output_queue, cancel_event = await submit_generation(question, tables)
+    tokens = []
+    try:
+        while (token := await output_queue.get()) is not None:
+            tokens.append(token)
+    finally:
+        cancel_event.set()
+    return "".join(tokens)
+
+def extract_sql(response):
+    if "```sql" in response:
+        return response.split("```sql")[-1].split("```")[0].strip()
+    return None
 
-generation_controller = {
-    "thread": None,
-    "stop_event": Event()
-}
 
 @app.get("/generate_sql")
-async def get_sql(request: QueryRequest):
+async def get_sql(request: QueryRequest, http_request: Request):
     """Endpoint for generating SQL from natural language"""
     try:
-        if generation_controller["thread"] and generation_controller["thread"].is_alive():
-            generation_controller["stop_event"].set()
-            generation_controller["thread"].join(timeout=1)
+        output_queue, cancel_event = await submit_generation(request.query, request.tables)
 
-        generation_controller["stop_event"] = Event()
+        async def stream_tokens(output_queue, cancel_event):
+            # send whole words instead of every sub-word token
+            buffer = ""
+            try:
+                while (token := await output_queue.get()) is not None:
+                    buffer += token
+                    boundary = max(buffer.rfind(" "), buffer.rfind("\n"))
+                    if boundary >= 0:
+                        # stop generating for clients that went away
+                        if await http_request.is_disconnected():
+                            return
+                        yield buffer[:boundary + 1]
+                        buffer = buffer[boundary + 1:]
+                if buffer:
+                    yield buffer
+            finally:
+                cancel_event.set()
 
-        question = request.query
-        tables = request.tables
+        return StreamingResponse(stream_tokens(output_queue, cancel_event), media_type="text/plain")
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Unexpected error: {str(e)}\n")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    
+@app.get("/generate_sql_batch")
+async def get_sql_batch(request: BatchQueryRequest):
+    """Endpoint for generating SQL for several questions at once"""
+    if len(request.questions) != len(request.tables_per_question):
+        raise HTTPException(status_code=400, detail="questions and tables_per_question must have the same length")
+    if len(request.questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUESTIONS} questions per batch")
 
-        prompt = create_prompt(question, tables)
-        messages = [
-            {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
-            {"role": "user", "content": prompt}
+    try:
+        # identical (question, tables) pairs are generated only once, the
+        # others are submitted together and batched in flight by the engine
+        keys = [
+            (question, frozenset(tables))
+            for question, tables in zip(request.questions, request.tables_per_question)
         ]
+        generations = {}
+        for question, tables in keys:
+            if (question, tables) not in generations:
+                generations[(question, tables)] = asyncio.create_task(
+                    generate_text(question, list(tables))
+                )
 
-        text = tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
-
-
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-
-        class StopOnEvent(StoppingCriteria):
-            def __init__(self, stop_event):
-                self.stop_event = stop_event
-
-            def __call__(self, *args, **kwargs):
-                return self.stop_event.is_set()
-
-        thread = Thread(
-            target=model.generate,
-            kwargs={
-                **model_inputs,
-                "max_new_tokens": 1024,
-                "streamer": streamer,
-                "stopping_criteria": [StopOnEvent(generation_controller["stop_event"])]
-            }
-        )
-        thread.start()
-        generation_controller["thread"] = thread
-        
-        def stream_tokens(streamer):
-            for token in streamer:
-                if generation_controller["stop_event"].is_set():
-                    break
-                yield token
+        try:
+            await asyncio.gather(*generations.values())
+        except BaseException:
+            # nobody will read the other generations, abort their engine requests
+            for task in generations.values():
+                task.cancel()
+            raise
+        return [
+            {"id": i, "sql": extract_sql(generations[key].result())}
+            for i, key in enumerate(keys)
+        ]
 
-        return StreamingResponse(stream_tokens(streamer), media_type="text/plain")
-        
     except HTTPException:
         raise
     except Exception as e:
         print(f"Unexpected error: {str(e)}\n")
         raise HTTPException(status_code=500, detail="Internal server error")
-    
+
 @app.get("/execute_sql")
-def execute_sql(request: ExecuteRequest):
+async def execute_sql(request: ExecuteRequest):
+    """Stream query results as NDJSON: a columns line, then row chunk lines"""
     try:
-        result = execute_sql_query(request.sql_query)
-        return result
+        chunks = stream_sql_query(request.sql_query)
+        # executes the query, the remaining chunks are iterated in a threadpool
+        first = await run_blocking(next, chunks)
+        if "error" in first:
+            return first
+
+        def stream_rows(chunks):
+            for chunk in chunks:
+                yield json.dumps(jsonable_encoder(chunk)) + "\n"
+
+        return StreamingResponse(stream_rows(chain([first], chunks)), media_type="application/x-ndjson")
     except Exception as e:
         return {"error": str(e)}
 
@@ -132,5 +321,5 @@ def execute_sql(request: ExecuteRequest):
 async def get_schema(request: SchemaRequest):
     return {
         "status": "success",
-        "schema": get_database_schema()
+        "schema": await run_blocking(get_database_schema)
     }
\ No newline at end of file
@@ -1,11 +1,68 @@
 import psycopg2
-from psycopg2 import sql, OperationalError
+from psycopg2 import OperationalError
+from psycopg2.pool import ThreadedConnectionPool
 import os
+import re
+from threading import Lock, BoundedSemaphore
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import sqlparse
+from functools import lru_cache
 
 load_dotenv()
 
+POOL_MAX_CONNECTIONS = 32
+
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
+# Leading whitespace and comments, then SELECT or a WITH ... SELECT
+_SELECT_RE = re.compile(r"^\s*(?:(?:--[^\n]*|/\*[\s\S]*?\*/)\s*)*(?:with\b[\s\S]*?\bselect\b|select\b)", re.I)
+# String literals (including E'' and dollar-quoted ones), quoted identifiers
+# and comments are matched whole so their contents are never mistaken for
+# keywords, parentheses or statement separators
+_TOKEN_RE = re.compile(
+    r"[eE]'(?:[^'\\]|\\[\s\S]|'')*'|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\""
+    r"|\$(\w*)\$[\s\S]*?\$\1\$|--[^\n]*|/\*[\s\S]*?\*/|[();]|\w+"
+)
+_DML_KEYWORDS = {"insert", "update", "delete", "merge"}
+
+def _is_single_read_statement(sql_query):
+    """
+    False when a data-modifying keyword appears outside any parentheses,
+    e.g. the main statement of WITH t AS (SELECT ...) DELETE FROM ...,
+    or when anything but comments follows a top-level semicolon
+    """
+    depth = 0
+    ended = False
+    for match in _TOKEN_RE.finditer(sql_query):
+        token = match.group(0)
+        if token.startswith(("--", "/*")):
+            continue
+        if ended:
+            return False
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0 and token == ";":
+            ended = True
+        elif depth == 0 and token.lower() in _DML_KEYWORDS:
+            return False
+    return True
+
+@lru_cache(maxsize=4096)
+def is_safe_sql(sql_query):
+    """
+    Only a single SELECT statement is allowed
+    Stacked statements are rejected, so a COMMIT cannot end the read-only
+    transaction; data-modifying statements nested inside a CTE are then
+    rejected by that read-only session
+    """
+    is_select = bool(_SELECT_RE.match(sql_query)) and _is_single_read_statement(sql_query)
+    if DEBUG and is_select != (sqlparse.parse(sql_query)[0].get_type() == "SELECT"):
+        print(f"SELECT check disagrees with sqlparse for query: {sql_query}\n")
+    return is_select
+
 class DatabaseManager:
     def __init__(self):
         self.conn_params = {
@@ -17,13 +74,48 @@ class DatabaseManager:
             "port": os.getenv("DB_PORT", "5432")
         }
         self.schema = None
+        self.pool = None
+        self.pool_lock = Lock()
+        # getconn raises instead of waiting once maxconn connections are out
+        self.pool_slots = BoundedSemaphore(POOL_MAX_CONNECTIONS)
 
+    def get_pool(self):
+        """Create the connection pool on first use"""
+        if self.pool is None:
+            with self.pool_lock:
+                if self.pool is None:
+                    try:
+                        self.pool = ThreadedConnectionPool(
+                            minconn=8, maxconn=POOL_MAX_CONNECTIONS, **self.conn_params
+                        )
+                    except OperationalError as e:
+                        raise OperationalError(f"Database connection failed: {str(e)}")
+        return self.pool
+
+    @contextmanager
     def get_connection(self):
-        """Establish a database connection"""
+        """
+        Check a connection out of the pool for the duration of one transaction
+        Waits for a free connection when all of them are in use
+        """
+        pool = self.get_pool()
+        self.pool_slots.acquire()
         try:
-            return psycopg2.connect(**self.conn_params)
-        except OperationalError as e:
-            raise Exception(f"Database connection failed: {str(e)}")
+            try:
+                conn = pool.getconn()
+            except psycopg2.Error as e:
+                raise OperationalError(f"Database connection failed: {str(e)}")
+
+            try:
+                # only SELECT queries are run, let postgres plan accordingly
+                if not conn.readonly:
+                    conn.set_session(readonly=True)
+                with conn:
+                    yield conn
+            finally:
+                pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self.pool_slots.release()
 
     def get_database_schema(self):
         """
@@ -35,78 +127,61 @@ class DatabaseManager:
         if self.schema:
             return self.schema
         
-        schema = []
-        
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cur:
+                    # One round trip: columns, primary keys and foreign keys
+                    # are aggregated per table with LATERAL subqueries
                     cur.execute("""
-                        SELECT table_name 
-                        FROM information_schema.tables 
-                        WHERE table_schema = 'public'
-                    """)
-                    tables = [row[0] for row in cur.fetchall()]
-
-                    for table in tables:
-                        cur.execute(sql.SQL("""
-                            SELECT 
-                                column_name, 
-                                data_type,
-                                is_nullable,
-                                column_default
-                            FROM information_schema.columns
-                            WHERE table_name = %s
-                            ORDER BY ordinal_position
-                        """), [table])
-                        
-                        columns = []
-                        for col in cur.fetchall():
-                            columns.append({
-                                "name": col[0],
-                                "type": col[1],
-                                "nullable": col[2] == 'YES',
-                                "default": col[3]
-                            })
-
-                        cur.execute(sql.SQL("""
-                            SELECT column_name
-                            FROM information_schema.key_column_usage
-                            WHERE table_name = %s
-                            AND constraint_name IN (
-                                SELECT constraint_name
-                                FROM information_schema.table_constraints
-                                WHERE table_name = %s
-                                AND constraint_type = 'PRIMARY KEY'
-                            )
-                        """), [table, table])
-                        
-                        primary_keys = [row[0] for row in cur.fetchall()]
-
-                        cur.execute(sql.SQL("""
-                            SELECT
-                                kcu.column_name,
-                                ccu.table_name AS foreign_table,
-                                ccu.column_name AS foreign_column
-                            FROM 
-                                information_schema.key_column_usage kcu
+                        SELECT
+                            t.table_name,
+                            COALESCE(cols.columns, '[]'::json),
+                            COALESCE(pks.primary_keys, '[]'::json),
+                            COALESCE(fks.foreign_keys, '[]'::json)
+                        FROM information_schema.tables t
+                        CROSS JOIN LATERAL (
+                            SELECT json_agg(json_build_object(
+                                'name', c.column_name,
+                                'type', c.data_type,
+                                'nullable', c.is_nullable = 'YES',
+                                'default', c.column_default
+                            ) ORDER BY c.ordinal_position) AS columns
+                            FROM information_schema.columns c
+                            WHERE c.table_schema = t.table_schema
+                            AND c.table_name = t.table_name
+                        ) cols
+                        CROSS JOIN LATERAL (
+                            SELECT json_agg(kcu.column_name ORDER BY kcu.ordinal_position) AS primary_keys
+                            FROM information_schema.table_constraints tc
+                            JOIN information_schema.key_column_usage kcu
+                                ON kcu.constraint_schema = tc.constraint_schema
+                                AND kcu.constraint_name = tc.constraint_name
+                            WHERE tc.table_schema = t.table_schema
+                            AND tc.table_name = t.table_name
+                            AND tc.constraint_type = 'PRIMARY KEY'
+                        ) pks
+                        CROSS JOIN LATERAL (
+                            SELECT json_agg(json_build_object(
+                                'column', kcu.column_name,
+                                'references', ccu.table_name || '(' || ccu.column_name || ')'
+                            )) AS foreign_keys
+                            FROM information_schema.table_constraints tc
+                            JOIN information_schema.key_column_usage kcu
+                                ON kcu.constraint_schema = tc.constraint_schema
+                                AND kcu.constraint_name = tc.constraint_name
                             JOIN information_schema.constraint_column_usage ccu
-                                ON ccu.constraint_name = kcu.constraint_name
-                            WHERE kcu.table_name = %s
-                            AND kcu.constraint_name IN (
-                                SELECT constraint_name
-                                FROM information_schema.table_constraints
-                                WHERE table_name = %s
-                                AND constraint_type = 'FOREIGN KEY'
-                            )
-                        """), [table, table])
-                        
-                        foreign_keys = []
-                        for fk in cur.fetchall():
-                            foreign_keys.append({
-                                "column": fk[0],
-                                "references": f"{fk[1]}({fk[2]})"
-                            })
+                                ON ccu.constraint_schema = tc.constraint_schema
+                                AND ccu.constraint_name = tc.constraint_name
+                            WHERE tc.table_schema = t.table_schema
+                            AND tc.table_name = t.table_name
+                            AND tc.constraint_type = 'FOREIGN KEY'
+                        ) fks
+                        WHERE t.table_schema = 'public'
+                    """)
 
+                    # psycopg2 decodes the json columns into python lists
+                    schema = []
+                    for table, columns, primary_keys, foreign_keys in cur.fetchall():
                         schema.append({
                             "name": table,
                             "columns": columns,
@@ -120,29 +195,79 @@ class DatabaseManager:
         except Exception as e:
             return {"error": str(e)}
 
+    def stream_sql_query(self, sql_query, chunk_size=1000):
+        """
+        Execute SQL query on a server-side cursor
+        Yields the columns first, then the rows in chunks of chunk_size
+        """
+        if not is_safe_sql(sql_query):
+            yield {"error": "Query not supported."}
+            return
+
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(name="exec_cursor") as cur:
+                    cur.arraysize = chunk_size
+                    cur.execute(sql_query)
+                    # description of a named cursor is only set after the first fetch
+                    rows = cur.fetchmany(chunk_size)
+                    yield {"columns": [desc[0] for desc in cur.description]}
+                    while rows:
+                        yield {"data": rows}
+                        # a short chunk is the last one, skip the empty FETCH
+                        if len(rows) < chunk_size:
+                            break
+                        rows = cur.fetchmany(chunk_size)
+
+        except psycopg2.Error as e:
+            yield {"error": str(e)}
+
     def execute_sql_query(self, sql_query):
         """
         Execute SQL query and return results with metadata
         Handles SELECT queries
         """
-        def is_safe_sql(sql_query):
-            return sqlparse.parse(sql_query)[0].get_type() == "SELECT"
-        
+        columns = []
+        data = []
+        for chunk in self.stream_sql_query(sql_query):
+            if "error" in chunk:
+                return chunk
+            if "columns" in chunk:
+                columns = chunk["columns"]
+            else:
+                data.extend(chunk["data"])
+
+        return {
+            "columns": columns,
+            "data": data,
+            "row_count": len(data)
+        }
+
+    def hash_sql_query(self, sql_query):
+        """
+        Hash the result rows of a SELECT query inside the database
+        Equal hashes and column types mean equal results, without fetching the rows
+        """
+        if not is_safe_sql(sql_query):
+            return {"error": "Query not supported."}
+
+        # rows are hashed as record text, without column names, so differing
+        # aliases still match; newlines keep a trailing line comment from
+        # swallowing the closing parenthesis
+        query = sql_query.strip().rstrip(";")
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cur:
-                    # Handle SELECT queries
-                    if is_safe_sql(sql_query):
-                        cur.execute(sql_query)
-                        columns = [desc[0] for desc in cur.description]
-                        data = cur.fetchall()
-                        return {
-                            "columns": columns,
-                            "data": data,
-                            "row_count": len(data)
-                        }
-                    else:
-                        return {"error": "Query not supported."}
+                    # record text is the same for e.g. a date and its ::text cast,
+                    # so the column types are compared along with the hash
+                    cur.execute("SELECT * FROM (\n" + query + "\n) t LIMIT 0")
+                    types = tuple(desc.type_code for desc in cur.description)
+
+                    cur.execute(
+                        "SELECT md5(string_agg(r, E'\\n' ORDER BY r)) "
+                        "FROM (SELECT t::text AS r FROM (\n" + query + "\n) t) hashed"
+                    )
+                    return {"hash": cur.fetchone()[0], "types": types}
 
         except psycopg2.Error as e:
             return {"error": str(e)}
@@ -180,26 +305,18 @@ class DatabaseManager:
         schema_text = []
         for table in schema:
             if filtered_tables is None or table['name'] in filtered_tables:
-                create_table_text = f"create table {table['name']} ("
-                
                 # Columns
-                columns = []
-                for column in table["columns"]:
-                    column_def = f"{column['name']} {column['type'].lower()}"
-                    columns.append(column_def)
-                create_table_text += ("\n" + ",\n".join(columns))
+                definitions = [f"{column['name']} {column['type'].lower()}" for column in table["columns"]]
                 
                 # Primary keys
                 if table["primary_keys"]:
-                    create_table_text += (f",\nprimary key ({', '.join(table['primary_keys'])})")
+                    definitions.append(f"primary key ({', '.join(table['primary_keys'])})")
                 
                 # Foreign keys
                 for fk in table["foreign_keys"]:
-                    create_table_text += (f",\nforeign key ({fk['column']}) references {fk['references']}")
-
-                create_table_text += "\n);"
+                    definitions.append(f"foreign key ({fk['column']}) references {fk['references']}")
 
-                schema_text.append(create_table_text)  
+                schema_text.append(f"create table {table['name']} (\n" + ",\n".join(definitions) + "\n);")
         
         return "\n".join(schema_text)
 
@@ -211,10 +328,23 @@ def get_database_schema(filtered_tables=None):
     """Public interface for schema retrieval"""
     return db_manager.get_formatted_schema(filtered_tables)
 
+@lru_cache(maxsize=128)
+def _cached_normalized_create_statement(tables_key):
+    return db_manager.get_normalized_create_statement(tables_key)
+
 def get_normalized_create_statement(filtered_tables=None):
-    """Public interface for schema retrieval"""
-    return db_manager.get_normalized_create_statement(filtered_tables)
+    """Public interface for schema retrieval, cached per set of tables"""
+    tables_key = None if filtered_tables is None else frozenset(filtered_tables)
+    return _cached_normalized_create_statement(tables_key)
 
 def execute_sql_query(sql_query):
     """Public interface for query execution"""
-    return db_manager.execute_sql_query(sql_query)
\ No newline at end of file
+    return db_manager.execute_sql_query(sql_query)
+
+def hash_sql_query(sql_query):
+    """Public interface for hashing query results"""
+    return db_manager.hash_sql_query(sql_query)
+
+def stream_sql_query(sql_query):
+    """Public interface for streaming query execution"""
+    return db_manager.stream_sql_query(sql_query)
\ No newline at end of file